@@ -32,7 +32,8 @@ except ImportError as e:
     sys.exit()
 
 
-@retry(wait_exponential_multiplier=1000, wait_exponential_max=10000)
+@retry(wait_exponential_multiplier=1000, wait_exponential_max=10000,
+       wait_jitter_max=1000)
 def count_concurrent_orders():
     # TODO: Move these to a config file
     # orders_url = 'https://api.planet.com/compute/ops/stats/orders/v2'
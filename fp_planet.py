@@ -1,4 +1,6 @@
 import argparse
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 import os
 from pathlib import Path
 
@@ -6,13 +8,21 @@ import shapely
 import geopandas as gpd
 
 from lib.logging_utils import create_logger
-from lib.lib import write_gdf, find_planet_scenes
+from lib.lib import write_gdf, find_scene_manifests, PlanetScene
 import lib.constants as constants
 
 logger = create_logger(__name__, 'sh', 'INFO')
 
 choices_format = ['shp', 'gpkg', 'geojson']
 CRS = 'epsg:4326'
+# Scenes sent to each worker process at a time
+CHUNKSIZE = 32
+
+
+def footprint_row(manifest, rel_to=None):
+    """Create the footprint row for the scene with the given manifest.
+    Module level so that it can be run in worker processes."""
+    return PlanetScene(manifest).get_footprint_row(rel_to=rel_to)
 
 
 def main(args):
@@ -20,23 +30,30 @@ def main(args):
     out_format = args.format
     parse_directory = args.input_directory
     relative_directory = args.relative_directory
+    processes = args.processes
 
     if not relative_directory:
         relative_directory = parse_directory
 
     logger.info('Searching for scenes in: {}'.format(parse_directory))
-    planet_scenes = find_planet_scenes(parse_directory)
-    logger.info('Found {:,} scenes to parse...'.format(len(planet_scenes)))
-
-    rows = [ps.get_footprint_row(rel_to=relative_directory)
-            for ps in planet_scenes]
-    gdf = gpd.GeoDataFrame(rows)
-
-    # Drop centroid column (can only write one geometry column and
-    # center_x and center_y remain)
-    gdf = gdf.drop(columns=constants.CENTROID)
-
-    gdf.crs = CRS
+    # Only locate manifests here, scenes are created when parsed
+    manifests = list(find_scene_manifests(parse_directory))
+    logger.info('Found {:,} scenes to parse...'.format(len(manifests)))
+
+    # Parsing each scene's metadata is independent, so split across
+    # processes
+    if processes > 1:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            rows = list(executor.map(partial(footprint_row,
+                                             rel_to=relative_directory),
+                                     manifests, chunksize=CHUNKSIZE))
+    else:
+        rows = [footprint_row(m, rel_to=relative_directory)
+                for m in manifests]
+
+    # Rows hold shapely geometries already, so set the geometry column
+    # and CRS on construction rather than afterwards
+    gdf = gpd.GeoDataFrame(rows, geometry=constants.GEOMETRY, crs=CRS)
 
     logger.info('Footprint created with {:,} records.'.format(len(gdf)))
 
@@ -57,6 +74,9 @@ if __name__ == '__main__':
     parser.add_argument('-r', '--relative_directory', type=os.path.abspath,
                         help='Path to create filepaths relative to in '
                              'footprint.')
+    parser.add_argument('-p', '--processes', type=int, default=os.cpu_count(),
+                        help='Number of processes to use to parse scene '
+                             'metadata.')
 
     args = parser.parse_args()
 
@@ -1,13 +1,25 @@
 import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import io
+from itertools import islice
 import numpy as np
 import os
 from pathlib import Path
 import sys
 
 import pandas as pd
+from psycopg2 import sql
 from tqdm import tqdm
+# Optional, parses CSVs with multiple threads into columnar buffers
+try:
+    from pyarrow import csv as pa_csv
+    HAS_PYARROW = True
+except ImportError:
+    HAS_PYARROW = False
 
 # from lib.db import Postgres, generate_sql
+from lib.db import copy_from_df
 from lib.lib import get_config
 from lib.logging_utils import create_logger, create_logfile_path
 import lib.constants as constants
@@ -17,12 +29,134 @@ logger = create_logger(__name__, 'sh', 'INFO')
 # External modules
 sys.path.append(str(Path(__file__).parent / '..'))
 try:
-    from db_utils.db import Postgres, generate_sql
+    from db_utils.db import Postgres
 except ImportError as e:
     logger.error('db_utils module not found. It should be adjacent to '
                  'the planet_tools directory. Path: \n{}'.format(sys.path))
     sys.exit()
 
+# Export column names to table column names
+COLUMN_RENAMER = {constants.SAT_OFF_NADIR: constants.OFF_NADIR_FLD,
+                  constants.SAT_AZIMUTH: constants.AZIMUTH}
+# Columns to read from each export, after renaming
+READ_COLUMNS = {constants.SCENE_NAME, constants.OFF_NADIR_FLD,
+                constants.AZIMUTH}
+# Angles are read as float32, ample for their precision, halving the
+# memory moved when merging records and computing off_nadir_signed
+READ_DTYPES = {constants.OFF_NADIR_FLD: np.float32,
+               constants.AZIMUTH: np.float32}
+READ_THREADS = 8
+TMP_SCENE_NAMES = 'tmp_off_nadir_scene_names'
+TMP_OFF_NADIR = 'tmp_off_nadir'
+
+
+def clean_column_name(column):
+    """Convert an export column name to the table column name. Column
+    names in exports may be quoted and use periods."""
+    column = column.replace('"', '')
+    column = COLUMN_RENAMER.get(column, column)
+
+    return column.replace('.', '_')
+
+
+def read_off_nadir_csv(csv):
+    """Read the needed columns from an off-nadir export, renaming them
+    to match the table so files with differently quoted headers line up."""
+    if HAS_PYARROW:
+        header = pd.read_csv(csv, nrows=0).columns
+        table = pa_csv.read_csv(csv, convert_options=pa_csv.ConvertOptions(
+            include_columns=[c for c in header
+                             if clean_column_name(c) in READ_COLUMNS]))
+        table = table.rename_columns([clean_column_name(c)
+                                      for c in table.column_names])
+        csv_df = table.to_pandas()
+    else:
+        csv_df = pd.read_csv(csv, usecols=lambda c: clean_column_name(c)
+                             in READ_COLUMNS)
+        csv_df.rename(columns=clean_column_name, inplace=True)
+
+    return csv_df.astype(READ_DTYPES)
+
+
+def upload_scene_names(db, scene_names):
+    """Copy scene names into a temporary table, so that records can be
+    filtered against other tables in the database rather than loading
+    those tables' IDs."""
+    db.cursor.execute(sql.SQL('DROP TABLE IF EXISTS {}').format(
+        sql.Identifier(TMP_SCENE_NAMES)))
+    db.cursor.execute(sql.SQL('CREATE TEMP TABLE {} ({} text PRIMARY KEY)').format(
+        sql.Identifier(TMP_SCENE_NAMES), sql.Identifier(constants.SCENE_NAME)))
+    buf = io.StringIO('\n'.join(scene_names))
+    db.cursor.copy_expert(sql.SQL('COPY {} ({}) FROM STDIN').format(
+        sql.Identifier(TMP_SCENE_NAMES),
+        sql.Identifier(constants.SCENE_NAME)).as_string(db.cursor), buf)
+
+
+def scene_name_conditions(exists_in=(), not_exists_in=()):
+    """WHERE conditions requiring t.scene_name to be present in every
+    (table, column) in exists_in and absent from every (table, column)
+    in not_exists_in."""
+    conditions = [sql.SQL("""{exists} (SELECT 1 FROM {tbl} x
+                                       WHERE x.{col} = t.{sn})""").format(
+        exists=sql.SQL(exists),
+        tbl=sql.Identifier(table),
+        col=sql.Identifier(column),
+        sn=sql.Identifier(constants.SCENE_NAME))
+        for tables, exists in ((exists_in, 'EXISTS'),
+                               (not_exists_in, 'NOT EXISTS'))
+        for table, column in tables]
+
+    return sql.SQL(' AND ').join(conditions)
+
+
+def select_scene_names(db, exists_in=(), not_exists_in=()):
+    """Select the uploaded scene names meeting the scene_name_conditions,
+    in a single query. Returned as an Index so that filtering records
+    with isin does not first convert a set."""
+    query = sql.SQL("SELECT t.{sn} FROM {tmp} t WHERE {conditions}").format(
+        sn=sql.Identifier(constants.SCENE_NAME),
+        tmp=sql.Identifier(TMP_SCENE_NAMES),
+        conditions=scene_name_conditions(exists_in, not_exists_in))
+    db.cursor.execute(query)
+
+    return pd.Index([r[0] for r in db.cursor.fetchall()], dtype=object)
+
+
+def stage_records(db, records):
+    """Copy records into a temporary table shaped like the off-nadir
+    table, so they can be filtered and inserted on the server."""
+    db.cursor.execute(sql.SQL('DROP TABLE IF EXISTS {}').format(
+        sql.Identifier(TMP_OFF_NADIR)))
+    db.cursor.execute(sql.SQL(
+        'CREATE TEMP TABLE {} (LIKE {} INCLUDING DEFAULTS)').format(
+        sql.Identifier(TMP_OFF_NADIR), sql.Identifier(constants.OFF_NADIR)))
+    copy_from_df(db.cursor, records, TMP_OFF_NADIR, geom_cols=[])
+
+
+def insert_staged_records(db, columns, exists_in=(), not_exists_in=(),
+                          dryrun=False):
+    """Insert the staged records meeting the scene_name_conditions into
+    the off-nadir table with a single INSERT ... SELECT. Returns the
+    number of records inserted, or that would be if dryrun."""
+    columns = sql.SQL(', ').join([sql.Identifier(c) for c in columns])
+    staged = sql.SQL("SELECT {columns} FROM {tmp} t WHERE {conditions}").format(
+        columns=columns,
+        tmp=sql.Identifier(TMP_OFF_NADIR),
+        conditions=scene_name_conditions(exists_in, not_exists_in))
+    if dryrun:
+        db.cursor.execute(sql.SQL('SELECT COUNT(*) FROM ({}) s').format(staged))
+        count = db.cursor.fetchone()[0]
+        db.connection.rollback()
+    else:
+        db.cursor.execute(sql.SQL('INSERT INTO {tbl} ({columns}) {staged}').format(
+            tbl=sql.Identifier(constants.OFF_NADIR),
+            columns=columns,
+            staged=staged))
+        count = db.cursor.rowcount
+        db.connection.commit()
+
+    return count
+
 
 def ingest_off_nadir(export_dir, onhand_scenes_only=True, new_only=True,
                      ext='.csv',
@@ -31,94 +165,116 @@ def ingest_off_nadir(export_dir, onhand_scenes_only=True, new_only=True,
     logger.info("Reading off-nadir csvs...")
     # TODO: update this to use db_utils syntax
     with Postgres(host=constants.SANDWICH, database=constants.PLANET) as db:
-        if constants.OFF_NADIR in db.list_db_tables():
-            tbl_exists = True
+        # Catalog lookup, rather than listing every table and view
+        db.cursor.execute('SELECT to_regclass(%s) IS NOT NULL',
+                          (constants.OFF_NADIR,))
+        tbl_exists = db.cursor.fetchone()[0]
+        if tbl_exists:
+            start_count = db.get_table_count(constants.OFF_NADIR)
+            logger.info('Starting count for {}.{}: '
+                        '{:,}'.format(constants.SANDWICH_POOL_PLANET,
+                                      constants.OFF_NADIR, start_count))
         else:
-            tbl_exists = False
             logger.info('Table "{}" not found. Will be '
                         'created.'.format(constants.OFF_NADIR))
-        if tbl_exists:
-            logger.info('Starting count for {}.{}: '
-                        '{:,}'.format(constants.SANDWICH_POOL_PLANET, constants.OFF_NADIR,
-                                      db.get_table_count(constants.OFF_NADIR)))
-
-        if onhand_scenes_only:
-            logger.info('Locating records where scene is on hand...')
-            # Get all onhand footprint ids
-            onhand_scenes = set(db.get_values(constants.SCENES, constants.ID))
-            # # Keep only records that are onhand
-            # records_to_add = records_to_add[
-            #     records_to_add[off_nadir_tbl_id].isin(onhand_scenes)]
-            # logger.info('Remaining records to add: '
-            #             '{:,}'.format(len(records_to_add)))
 
         all_dfs = []
         # Locate all off-nadir files
-        csvs = [os.path.join(export_dir, f) for f in os.listdir(export_dir)
-                if f.endswith(ext)]
+        with os.scandir(export_dir) as entries:
+            csvs = [e.path for e in entries
+                    if e.name.endswith(ext) and e.is_file()]
 
         logger.info('Reading {} files in {}...'.format(ext, export_dir))
-        pbar = tqdm(csvs, desc='Reading files')
-        # Create and clean up a dataframe for each file
-        for csv in pbar:
-            csv_df = pd.read_csv(csv)
-            # Rename columns to match table names
-            csv_df.rename(columns={constants.SAT_OFF_NADIR: constants.OFF_NADIR_FLD,
-                                   constants.SAT_AZIMUTH: constants.AZIMUTH},
-                          inplace=True)
-            # Column names are quoted... remove
-            csv_df.rename(columns={c: c.replace('"', '')
-                                   for c in csv_df.columns},
-                          inplace=True)
-            # Replace periods in column names with underscore
-            csv_df.rename(columns={c: c.replace(".", '_')
-                                   for c in csv_df.columns},
-                          inplace=True)
-            # Add off_nadir_signed column
-            csv_df[constants.OFF_NADIR_SIGNED] = np.sign(csv_df[constants.AZIMUTH]) * \
-                                       csv_df[constants.OFF_NADIR_FLD]
-            # Keep only relevant columns
-            csv_df = csv_df[[constants.SCENE_NAME,
-                             constants.OFF_NADIR_FLD,
-                             constants.AZIMUTH,
-                             constants.OFF_NADIR_SIGNED]]
-            if onhand_scenes_only:
-                # Keep only records that are onhand
-                csv_df = csv_df[csv_df[constants.SCENE_NAME].isin(onhand_scenes)]
-
-            all_dfs.append(csv_df)
-
-        logger.info('Merging records from each file, removing duplicates...')
+        # Files are read concurrently, but processed in order, with at most
+        # READ_THREADS reads in flight: the next file is only submitted once
+        # the oldest read has finished. Duplicates are removed as each
+        # file is processed, keeping the first record for each scene, so all
+        # records are never held at once.
+        seen = set()
+        total_records = 0
+        csvs_iter = iter(csvs)
+        with ThreadPoolExecutor(max_workers=READ_THREADS) as executor:
+            pending = deque(executor.submit(read_off_nadir_csv, c)
+                            for c in islice(csvs_iter, READ_THREADS))
+            pbar = tqdm(total=len(csvs), desc='Reading files')
+            while pending:
+                csv_df = pending.popleft().result()
+                next_csv = next(csvs_iter, None)
+                if next_csv is not None:
+                    pending.append(executor.submit(read_off_nadir_csv, next_csv))
+                pbar.update(1)
+                total_records += len(csv_df)
+                csv_df = csv_df[~csv_df[constants.SCENE_NAME].isin(seen)]
+                csv_df = csv_df.drop_duplicates(subset=constants.SCENE_NAME)
+                seen.update(csv_df[constants.SCENE_NAME])
+                all_dfs.append(csv_df)
+            pbar.close()
+
+        logger.info('Merging records from each file...')
         logger.info('Total files: {:,}'.format(len(all_dfs)))
-        logger.info('Total records: {:,}'.format(sum([len(df)
-                                                      for df in all_dfs])))
-        records_to_add = pd.concat(all_dfs)
-        records_to_add.drop_duplicates(subset=constants.SCENE_NAME, inplace=True)
+        logger.info('Total records: {:,}'.format(total_records))
+        records_to_add = pd.concat(all_dfs, ignore_index=True)
+        # Add off_nadir_signed column: off_nadir with the sign of azimuth
+        azimuth = records_to_add[constants.AZIMUTH].to_numpy()
+        off_nadir = records_to_add[constants.OFF_NADIR_FLD].to_numpy()
+        off_nadir_signed = np.copysign(off_nadir, azimuth)
+        # Zero or missing azimuths have no sign, as with np.sign
+        unsigned = (azimuth == 0) | np.isnan(azimuth)
+        off_nadir_signed[unsigned] = np.sign(azimuth[unsigned]) * \
+            off_nadir[unsigned]
+        records_to_add[constants.OFF_NADIR_SIGNED] = off_nadir_signed
+        # Order columns
+        records_to_add = records_to_add[[constants.SCENE_NAME,
+                                         constants.OFF_NADIR_FLD,
+                                         constants.AZIMUTH,
+                                         constants.OFF_NADIR_SIGNED]]
         logger.info('Unique records found: {:,}'.format(len(records_to_add)))
 
+        # Filter records against the scenes and off-nadir tables in the
+        # database, rather than loading all of their IDs
+        exists_in = []
+        if onhand_scenes_only:
+            # Keep only records that are onhand
+            exists_in.append((constants.SCENES, constants.ID))
+
         if tbl_exists and new_only:
-            # Only add new values, do not overwrite existing
-            logger.info('Locating new records...')
-            sql = generate_sql(layer=constants.OFF_NADIR,
-                               columns=constants.SCENE_NAME)
-            # Get IDs all records currently in off-nadir table
-            existing_off_nadirs = set(
-                db.sql2df(sql_str=sql, columns=constants.SCENE_NAME)[constants.SCENE_NAME])
-            # Keep only records not currently in off-nadir table
-            records_to_add = records_to_add[
-                ~records_to_add[constants.SCENE_NAME].isin(existing_off_nadirs)]
-            logger.info('Remaining records to add: '
-                        '{:,}'.format(len(records_to_add)))
-
-        if len(records_to_add) == 0:
-            logger.debug('No records to add.')
-            sys.exit()
-
-        # Add records to table
-        logger.info('Adding new records...')
-        db.insert_new_records(records_to_add, constants.OFF_NADIR, dryrun=dryrun)
-        logger.info('New records added. New table count:'
-                    ' {:,}'.format(db.get_table_count(constants.OFF_NADIR)))
+            # Only add new values, do not overwrite existing. Records are
+            # staged on the server and only those not in the off-nadir
+            # table (and onhand) are inserted, in a single statement
+            logger.info('Staging records...')
+            stage_records(db, records_to_add)
+            logger.info('Adding new records...')
+            added = insert_staged_records(
+                db, records_to_add.columns, exists_in=exists_in,
+                not_exists_in=[(constants.OFF_NADIR, constants.SCENE_NAME)],
+                dryrun=dryrun)
+            if dryrun:
+                logger.info('-dryrun- Records to add: {:,}'.format(added))
+            else:
+                logger.info('Records added: {:,}'.format(added))
+                # Counted from the insert, rather than recounting the table
+                logger.info('New table count: '
+                            '{:,}'.format(start_count + added))
+        else:
+            if exists_in:
+                logger.info('Locating records where scene is on hand...')
+                upload_scene_names(db, records_to_add[constants.SCENE_NAME])
+                keep_scenes = select_scene_names(db, exists_in=exists_in)
+                records_to_add = records_to_add[
+                    records_to_add[constants.SCENE_NAME].isin(keep_scenes)]
+                logger.info('Remaining records to add: '
+                            '{:,}'.format(len(records_to_add)))
+
+            if len(records_to_add) == 0:
+                logger.debug('No records to add.')
+                sys.exit()
+
+            # Add records to table
+            logger.info('Adding new records...')
+            db.insert_new_records(records_to_add, constants.OFF_NADIR,
+                                  dryrun=dryrun)
+            logger.info('New records added. New table count:'
+                        ' {:,}'.format(db.get_table_count(constants.OFF_NADIR)))
 
 
 if __name__ == '__main__':
@@ -1,14 +1,27 @@
 from datetime import datetime
+from functools import lru_cache
+import logging
 import os
 from pathlib import Path
+import random
+import shutil
+import tempfile
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 from tqdm import tqdm
 
 try:
     import boto3
+    from boto3.s3.transfer import TransferConfig
+    from botocore.config import Config
+    from botocore.exceptions import BotoCoreError, ClientError
+    from s3transfer.manager import TransferManager
+    from s3transfer.subscribers import BaseSubscriber
 except ImportError:
     print('Warning: boto3 import failed, delivery via AWS will not work.')
+    BaseSubscriber = object
 
 from lib.lib import get_config
 from lib.logging_utils import create_logger
@@ -17,52 +30,216 @@ logger = create_logger(__name__, 'sh', 'INFO')
 
 
 # AWS
-AWS_PARAMS = get_config("aws")
-AWS_ACCESS_KEY_ID = AWS_PARAMS["aws_access_key_id"]
-AWS_SECRET_ACCESS_KEY = AWS_PARAMS["aws_secret_access_key"]
-AWS_BUCKET = AWS_PARAMS["aws_bucket"]
-AWS_REGION = AWS_PARAMS["aws_region"]
-AWS_PATH_PREFIX = AWS_PARAMS["aws_path_prefix"]
+AWS = 'aws'
+AWS_ACCESS_KEY_ID = 'aws_access_key_id'
+AWS_SECRET_ACCESS_KEY = 'aws_secret_access_key'
+AWS_BUCKET = 'aws_bucket'
+AWS_REGION = 'aws_region'
+AWS_PATH_PREFIX = 'aws_path_prefix'
 BUCKET_NAME = 'pgc-data'
 
 # Constants
 S3 = 's3'
+LIST_PAGE_SIZE = 1000
+MB = 1024 * 1024
+# Downloads - objects larger than MULTIPART_THRESHOLD are fetched as
+# concurrent ranged GETs of MULTIPART_CHUNKSIZE bytes, each written to
+# its offset in the destination file
+TRANSFER_MAX_CONCURRENCY = 64
+TRANSFER_MIN_CONCURRENCY = 4
+MULTIPART_THRESHOLD = 8 * MB
+MULTIPART_CHUNKSIZE = 8 * MB
+# Threads used to move files from scratch to destination
+MOVE_THREADS = 4
+# Threads used to check for pending orders' manifests
+MANIFEST_CHECK_THREADS = 16
+# Seconds between checks of whether a shared manifest watcher has finished
+WATCH_DONE_INTERVAL = 5
 
+# Order IDs whose manifest has been located in the bucket
+_manifests_found = set()
+# Per-thread S3 clients used for downloads, by credentials
+_thread_local = threading.local()
+# Credentials each connected bucket was created with, by id of the
+# bucket. Connected buckets are cached for the life of the process, so
+# their ids are not reused.
+_bucket_credentials = {}
 
+
+class TransferSizeSubscriber(BaseSubscriber):
+    """
+    Provide the size of an object to its transfer when queued. Sizes are
+    already known from listing the bucket, so this saves the HEAD request
+    TransferManager would otherwise make before each download.
+    """
+    def __init__(self, size):
+        self.size = size
+
+    def on_queued(self, future, **kwargs):
+        future.meta.provide_transfer_size(self.size)
+
+
+def get_aws_param(param):
+    """
+    Get an AWS parameter from the config. Parameters are looked up when
+    first needed rather than at import, so importing this module does not
+    require AWS to be configured.
+    """
+    return get_config(AWS)[param]
+
+
+@lru_cache(maxsize=None)
 def connect_aws_bucket(bucket_name=BUCKET_NAME,
-                       aws_access_key_id=AWS_ACCESS_KEY_ID,
-                       aws_secret_access_key=AWS_SECRET_ACCESS_KEY):
+                       aws_access_key_id=None,
+                       aws_secret_access_key=None):
+    """
+    Connect to the AWS bucket. The resource (and its client's connection
+    pool) is created once and shared by all callers with the same
+    arguments. The bucket's client is only used for listing and manifest
+    checks, downloads use per-thread clients (see get_thread_client).
+    Credentials default to those in the config.
+    """
+    if aws_access_key_id is None:
+        aws_access_key_id = get_aws_param(AWS_ACCESS_KEY_ID)
+    if aws_secret_access_key is None:
+        aws_secret_access_key = get_aws_param(AWS_SECRET_ACCESS_KEY)
+    config = Config(max_pool_connections=MANIFEST_CHECK_THREADS,
+                    retries={'mode': 'adaptive', 'max_attempts': 10})
     s3 = boto3.resource(S3, aws_access_key_id=aws_access_key_id,
-                        aws_secret_access_key=aws_secret_access_key, )
+                        aws_secret_access_key=aws_secret_access_key,
+                        config=config)
     bucket = s3.Bucket(bucket_name)
+    _bucket_credentials[id(bucket)] = (aws_access_key_id,
+                                       aws_secret_access_key)
 
     return bucket
 
 
+def get_thread_client(bucket):
+    """
+    Get an S3 client for the calling thread with the same credentials as
+    bucket, creating it from a new session on first use. Each order
+    download thread then has its own connection pool rather than
+    contending for the shared bucket's. Buckets not created by
+    connect_aws_bucket use the credentials in the config.
+    """
+    credentials = _bucket_credentials.get(id(bucket))
+    if credentials is None:
+        credentials = (get_aws_param(AWS_ACCESS_KEY_ID),
+                       get_aws_param(AWS_SECRET_ACCESS_KEY))
+    clients = getattr(_thread_local, 'clients', None)
+    if clients is None:
+        clients = _thread_local.clients = {}
+    client = clients.get(credentials)
+    if client is None:
+        aws_access_key_id, aws_secret_access_key = credentials
+        config = Config(max_pool_connections=TRANSFER_MAX_CONCURRENCY,
+                        retries={'mode': 'adaptive', 'max_attempts': 10})
+        session = boto3.session.Session(aws_access_key_id=aws_access_key_id,
+                                        aws_secret_access_key=aws_secret_access_key)
+        client = session.client(S3, config=config)
+        clients[credentials] = client
+
+    return client
+
+
 def manifest_exists(order_id, bucket):
     """
     Check if source for given order id exists in AWS bucket.
     Manifest is last file delivered for order and so presence
     order is ready to download.
     """
+    # Manifests are not removed once delivered, so only positive results
+    # are cached
+    if str(order_id) in _manifests_found:
+        return True
     # Path to source for order
-    mani_path = AWS_PATH_PREFIX / Path(order_id) / 'source.json'
-    # Get files that match source path - should only be one
-    mani_filter = bucket.objects.filter(Prefix=mani_path.as_posix())
-    objs = list(mani_filter)
-    if len(objs) >= 1 and objs[0].key == mani_path.as_posix():
-        logger.debug('Manifest for {} exists.'.format(order_id))
-        mani_exists = True
+    mani_path = get_aws_param(AWS_PATH_PREFIX) / Path(order_id) / 'source.json'
+    # A single HEAD request on the known key, rather than a LIST
+    try:
+        bucket.meta.client.head_object(Bucket=bucket.name,
+                                       Key=mani_path.as_posix())
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+            return False
+        raise
+    logger.debug('Manifest for {} exists.'.format(order_id))
+    _manifests_found.add(str(order_id))
+
+    return True
+
+
+def list_objects(bucket, prefix):
+    """
+    List all objects under prefix in the bucket, excluding directory keys.
+    Uses the low-level list_objects_v2 paginator, returning the raw
+    dicts ('Key', 'Size', ...) rather than an ObjectSummary per key.
+    """
+    paginator = bucket.meta.client.get_paginator('list_objects_v2')
+    pages = paginator.paginate(Bucket=bucket.name, Prefix=prefix,
+                               PaginationConfig={'PageSize': LIST_PAGE_SIZE})
+    objects = [obj for page in pages for obj in page.get('Contents', [])
+               if not obj['Key'].endswith('/')]
+
+    return objects
+
+
+def scan_local_files(directory):
+    """
+    Get the (size, modified time) of all files under directory, keyed by
+    path, by walking the tree once with os.scandir. Used to avoid stat-ing
+    each destination path individually, which is slow on network shares.
+    """
+    local_files = {}
+    if not os.path.isdir(directory):
+        return local_files
+    stack = [str(directory)]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                else:
+                    st = entry.stat()
+                    local_files[entry.path] = (st.st_size, st.st_mtime)
+
+    return local_files
+
+
+def transfer_concurrency(n_files, total_bytes):
+    """
+    Choose the number of concurrent requests for downloading an order.
+    Orders of mostly small files are bound by request latency and benefit
+    from many concurrent requests, while orders of a few large files are
+    bound by bandwidth and are split into ranged GETs, so need fewer.
+    """
+    if not n_files:
+        return TRANSFER_MIN_CONCURRENCY
+    if total_bytes / n_files < MULTIPART_THRESHOLD:
+        concurrency = max(8, n_files // 50)
     else:
-        mani_exists = False
+        concurrency = max(TRANSFER_MIN_CONCURRENCY,
+                          min(16, total_bytes // (128 * MB)))
 
-    return mani_exists
+    return int(min(TRANSFER_MAX_CONCURRENCY, concurrency))
 
 
-def create_aws_delivery(aws_access_key_id=AWS_ACCESS_KEY_ID,
-                        aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-                        bucket=AWS_BUCKET, aws_region=AWS_REGION,
-                        path_prefix=AWS_PATH_PREFIX):
+def create_aws_delivery(aws_access_key_id=None,
+                        aws_secret_access_key=None,
+                        bucket=None, aws_region=None,
+                        path_prefix=None):
+    """Create the delivery section of an order request for delivery to
+    the AWS bucket. Any parameters not passed are taken from the config."""
+    if aws_access_key_id is None:
+        aws_access_key_id = get_aws_param(AWS_ACCESS_KEY_ID)
+    if aws_secret_access_key is None:
+        aws_secret_access_key = get_aws_param(AWS_SECRET_ACCESS_KEY)
+    if bucket is None:
+        bucket = get_aws_param(AWS_BUCKET)
+    if aws_region is None:
+        aws_region = get_aws_param(AWS_REGION)
+    if path_prefix is None:
+        path_prefix = get_aws_param(AWS_PATH_PREFIX)
     aws_delivery = {
         "delivery": {
             "amazon_s3": {
@@ -78,65 +255,212 @@ def create_aws_delivery(aws_access_key_id=AWS_ACCESS_KEY_ID,
     return aws_delivery
 
 
-def check_aws_delivery_status(order_id, bucket, start_time, wait_max,
-                              wait_interval, wait_max_interval):
-    # Check for presence of source, sleeping between checks.
-    while running_time < wait_max and not start_dl:
-        exists = manifest_exists(order_id, bucket=bucket)
-        if not exists:
-            running_time = (datetime.datetime.now() - start_time).total_seconds()
-            logger.debug('Manifest not present for order ID: {} :'
-                         ' {}s remaining'.format(order_id, round(wait_max - running_time)))
-            time.sleep(wait)
-            if wait <= wait_max_interval:
-                wait += wait_interval
-            if wait > wait_max_interval:
-                wait = wait_max_interval
-        else:
-            logger.debug('Manifest present - beginning download: {}'.format(order_id))
-            start_dl = True
+def watch_aws_deliveries(manifest_events, bucket, wait_max, wait_start=2,
+                         wait_max_interval=300, watch_done=None):
+    """
+    Poll the bucket for the manifests of all orders from a single thread,
+    rather than one polling loop per order, checking the pending orders
+    concurrently on each sweep. Each order's event in
+    manifest_events is set once its manifest is present. The wait between
+    checks starts at [wait_start] seconds and doubles (plus random jitter)
+    after each check that finds no new manifests, up to
+    [wait_max_interval]. Returns once all manifests are found or
+    [wait_max] is reached, setting watch_done (if passed) so that those
+    waiting on manifest_events know no more will be set.
+    """
+    start_time = datetime.now()
+    running_time = 0
+    attempt = 0
+    pending = set(manifest_events)
+    try:
+        with ThreadPoolExecutor(max_workers=MANIFEST_CHECK_THREADS) as executor:
+            while pending and running_time < wait_max:
+                found = False
+                # Check all pending manifests concurrently, so each sweep takes
+                # about one request's latency rather than one per order
+                futures = {order_id: executor.submit(manifest_exists, order_id,
+                                                     bucket=bucket)
+                           for order_id in pending}
+                for order_id, future in futures.items():
+                    try:
+                        exists = future.result()
+                    except (ClientError, BotoCoreError) as e:
+                        # Transient (e.g. 5xx or connection) errors, try
+                        # again next check
+                        logger.warning('Error checking for manifest: {}'.format(order_id))
+                        logger.warning(e)
+                        continue
+                    if exists:
+                        logger.debug('Manifest present - beginning download: {}'.format(order_id))
+                        manifest_events[order_id].set()
+                        pending.remove(order_id)
+                        found = True
+                if pending:
+                    # Back off only while nothing is arriving
+                    attempt = 0 if found else attempt + 1
+                    wait = (min(wait_max_interval, wait_start * (2 ** attempt)) +
+                            random.uniform(0, wait_start))
+                    running_time = (datetime.now() - start_time).total_seconds()
+                    logger.debug('Manifests not present for {:,} orders: '
+                                 '{}s remaining'.format(len(pending),
+                                                        round(wait_max - running_time)))
+                    time.sleep(wait)
+    finally:
+        if watch_done is not None:
+            watch_done.set()
+
+    return pending
+
+
+def check_aws_delivery_status(order_id, bucket, wait_max, wait_start=2,
+                              wait_max_interval=300, manifest_event=None,
+                              watch_done=None):
+    """
+    Wait for the manifest of order_id to be present in the bucket. If
+    manifest_event is passed it is expected to be set by a shared
+    watch_aws_deliveries thread, which sets watch_done when it finishes,
+    otherwise the bucket is polled for this order alone.
+    """
+    if manifest_event is None:
+        manifest_event = threading.Event()
+        watch_aws_deliveries({order_id: manifest_event}, bucket=bucket,
+                             wait_max=wait_max, wait_start=wait_start,
+                             wait_max_interval=wait_max_interval)
+        return manifest_event.is_set()
+
+    if watch_done is None:
+        return manifest_event.wait(timeout=wait_max)
+    # Wait until the manifest is found or the watcher gives up, rather than
+    # a full wait_max from when this order's turn came
+    while not manifest_event.wait(timeout=WATCH_DONE_INTERVAL):
+        if watch_done.is_set():
+            return manifest_event.is_set()
 
-    return start_dl
+    return True
 
 
 def dl_aws(oid, dst_par_dir, oid_dir, bucket, overwrite=False,
-           dryrun=False):
+           dryrun=False, scratch_dir=None):
+    """
+    Download all files for an order id from the AWS bucket. Files are
+    submitted to a single TransferManager so that they are downloaded
+    concurrently rather than one GET at a time. If scratch_dir is
+    provided, files are downloaded to a temporary directory there (i.e.
+    local disk) and moved to the destination as each one completes,
+    while the remaining downloads continue. Returns the keys that failed
+    to download.
+    """
     # Filter the bucket for the order id, removing any directory keys
-    order_prefix = '{}/{}'.format(AWS_PATH_PREFIX, oid)
-    bucket_filter = [bo for bo in bucket.objects.filter(Prefix=order_prefix)
-                     if not bo.key.endswith('/')]
-    # Set up progress bar
-    # For setting progress bar length
-    item_count = len([x for x in bucket_filter])
-    pbar = tqdm(bucket_filter, total=item_count, desc='Order: {}'.format(oid), position=1)
-    # For aligning arrows in progress bar writing
-    # arrow_loc = max([len(x.key) for x in bucket_filter]) - len(order_prefix)
+    path_prefix = get_aws_param(AWS_PATH_PREFIX).rstrip('/')
+    order_prefix = '{}/{}'.format(path_prefix, oid)
+    bucket_filter = list_objects(bucket, prefix=order_prefix)
+    item_count = len(bucket_filter)
+    # Only build per-file log messages if they will be emitted
+    log_debug = logger.isEnabledFor(logging.DEBUG)
 
     logger.info('Downloading {:,} files to: {}'.format(item_count, oid_dir))
-    for bo in pbar:
-        # Determine source and destination full paths
-        aws_loc = Path(bo.key)
-        # Create destination subdirectory path with order id as subdirectory
-        dst_path = dst_par_dir / aws_loc.relative_to(Path(AWS_PATH_PREFIX))
-        if not os.path.exists(dst_path.parent):
-            os.makedirs(dst_path.parent)
-
-        # Download
-        if os.path.exists(dst_path) and not overwrite:
-            logger.debug('File exists at destination, skipping: {}'.format(dst_path))
+    # Sizes and modified times of files already in the destination
+    local_files = scan_local_files(oid_dir)
+    # Determine source and destination full paths of files to download.
+    # Keys all start with the known prefix, so plain string operations are
+    # used rather than building several Path objects per key
+    prefix_len = len(path_prefix) + 1
+    dst_str = str(dst_par_dir)
+    # Largest files first, so the long multipart transfers start right
+    # away and the many small sidecar files fill in the remaining
+    # connections, rather than a large file starting last and running alone
+    bucket_filter.sort(key=lambda obj: obj['Size'], reverse=True)
+    to_download = []
+    total_bytes = 0
+    for obj in bucket_filter:
+        key = obj['Key']
+        # Destination path with order id as subdirectory
+        dst_path = os.path.normpath(os.path.join(dst_str, key[prefix_len:]))
+
+        # Only skip existing files that match the size in AWS and are not
+        # older than the object, otherwise partial or stale downloads would
+        # never be retried
+        local = local_files.get(dst_path)
+        if (not overwrite and local and local[0] == obj['Size'] and
+                local[1] >= obj['LastModified'].timestamp()):
+            if log_debug:
+                logger.debug('File exists at destination, skipping: {}'.format(dst_path))
             continue
-        else:
-            logger.debug('Downloading file: {}\n\t--> {}'.format(aws_loc, dst_path.absolute()))
-            # pbar.write('Downloading: {}{}-> {}'.format(aws_loc.relative_to(*aws_loc.parts[:3]),
-            #                                            ' '*(arrow_loc - len(str(aws_loc.relative_to(*aws_loc.parts[:3])))),
-            #                                            oid_dir.relative_to(*dst_par_dir.parts[:9])))
-        dl_issues = set()
-        if not dryrun:
-            try:
-                bucket.download_file(bo.key, str(dst_path))
-                dl_issues.add(False)
-            except Exception as e:
-                logger.error('Error downloading: {}'.format(aws_loc))
-                logger.error(e)
-                dl_issues.add(True)
-    return dl_issues
+        elif log_debug:
+            logger.debug('Downloading file: {}\n\t--> {}'.format(key, dst_path))
+        to_download.append((key, dst_path, obj['Size']))
+        total_bytes += obj['Size']
+
+    # Keys that failed to download or move to the destination
+    failed_keys = []
+    if dryrun or not to_download:
+        return failed_keys
+
+    # Create each destination subdirectory once, rather than once per file
+    for parent in sorted({os.path.dirname(dst_path) for _, dst_path, _ in to_download}):
+        os.makedirs(parent, exist_ok=True)
+
+    if scratch_dir:
+        scratch = tempfile.mkdtemp(prefix='{}_'.format(oid), dir=scratch_dir)
+    else:
+        scratch = None
+    try:
+        if scratch:
+            logger.debug('Downloading to scratch directory: {}'.format(scratch))
+            for parent in sorted({os.path.dirname(os.path.relpath(dst_path, dst_str))
+                                  for _, dst_path, _ in to_download}):
+                os.makedirs(os.path.join(scratch, parent), exist_ok=True)
+
+        # Submit all files at once, TransferManager downloads them concurrently
+        max_concurrency = transfer_concurrency(len(to_download), total_bytes)
+        logger.debug('Download concurrency: {}'.format(max_concurrency))
+        transfer_config = TransferConfig(max_concurrency=max_concurrency,
+                                         multipart_threshold=MULTIPART_THRESHOLD,
+                                         multipart_chunksize=MULTIPART_CHUNKSIZE,
+                                         use_threads=True)
+        with TransferManager(get_thread_client(bucket), config=transfer_config) as transfer, \
+                ThreadPoolExecutor(max_workers=MOVE_THREADS) as mover:
+            futures = []
+            for key, dst_path, size in to_download:
+                if scratch:
+                    dl_path = os.path.join(scratch,
+                                           os.path.relpath(dst_path, dst_str))
+                else:
+                    dl_path = dst_path
+                future = transfer.download(
+                    bucket.name, key, dl_path,
+                    subscribers=[TransferSizeSubscriber(size)])
+                futures.append((future, key, dl_path, dst_path))
+
+            moves = []
+            pbar = tqdm(futures, desc='Order: {}'.format(oid), position=1)
+            for future, key, dl_path, dst_path in pbar:
+                try:
+                    future.result()
+                except Exception as e:
+                    logger.error('Error downloading: {}'.format(key))
+                    logger.error(e)
+                    failed_keys.append(key)
+                    continue
+                if scratch:
+                    moves.append((mover.submit(shutil.move, dl_path, dst_path),
+                                  key))
+
+            for move, key in moves:
+                try:
+                    move.result()
+                except Exception as e:
+                    logger.error('Error moving download to destination: '
+                                 '{}'.format(key))
+                    logger.error(e)
+                    failed_keys.append(key)
+    finally:
+        # Also removes any partial downloads if an error was raised
+        if scratch:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+    if failed_keys:
+        logger.warning('Failed to download {:,} of {:,} files for order: '
+                       '{}'.format(len(failed_keys), len(to_download), oid))
+
+    return failed_keys
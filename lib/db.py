@@ -1,3 +1,4 @@
+import io
 import json
 import re
 import os
@@ -6,11 +7,11 @@ import sys
 import time
 
 from sqlalchemy import create_engine
-from tqdm import tqdm
 import psycopg2
 from psycopg2 import sql
 import pandas as pd
 import geopandas as gpd
+from shapely import wkb
 
 from .lib import get_config, get_geometry_cols
 from .logging_utils import create_logger
@@ -216,6 +217,41 @@ def intersect_aoi_where(aoi, geom_col='geometry'):
     return aoi_where
 
 
+def copy_from_df(cursor, records, table, geom_cols=None):
+    """
+    Write records to table with a single COPY FROM STDIN, rather than an
+    INSERT per row. Geometry columns are written as hex EWKB using the
+    SRID of the records' CRS. The caller is responsible for committing.
+    cursor : psycopg2.extensions.cursor
+        Cursor to COPY with
+    records : pd.DataFrame / gpd.GeoDataFrame
+        DataFrame containing rows to be written to table
+    table : str
+        Name of table to be written to
+    geom_cols : list
+        Names of geometry columns in records, located if not provided
+    """
+    if geom_cols is None:
+        geom_cols = get_geometry_cols(records)
+    if geom_cols:
+        srid = records.crs.to_epsg()
+        records = pd.DataFrame({c: [wkb.dumps(g, hex=True, srid=srid)
+                                    for g in records[c]]
+                                if c in geom_cols else records[c]
+                                for c in records.columns})
+
+    buf = io.StringIO()
+    records.to_csv(buf, index=False, header=False)
+    buf.seek(0)
+
+    copy_statement = sql.SQL(
+        "COPY {table} ({columns}) FROM STDIN WITH (FORMAT CSV)").format(
+        table=sql.Identifier(table),
+        columns=sql.SQL(', ').join([sql.Identifier(c)
+                                    for c in records.columns]))
+    cursor.copy_expert(copy_statement.as_string(cursor), buf)
+
+
 class Postgres(object):
     """
     Class for interacting with Postgres database using psycopg2. This
@@ -410,7 +446,10 @@ class Postgres(object):
         """
         Add records to table, converting data types as necessary for INSERT.
         Optionally using a unique_id (or combination of columns) to skip
-        duplicates.
+        duplicates. Records are written in a single transaction, so an error
+        in any row rolls back the whole batch rather than skipping that row.
+        Note: scripts currently import Postgres from db_utils.db, so they
+        do not use this method.
         records : pd.DataFrame / gpd.GeoDataFrame
             DataFrame containing rows to be inserted to table
         table : str
@@ -419,31 +458,6 @@ class Postgres(object):
         # TODO: Create overwrite scenes option that removes any scenes in the
         #  input from the DB before writing them
 
-        def _row_columns_unique(row, unique_on, values):
-            """Determines if row has combination of columns in unique_on that
-            are in values.
-            Parameters
-            ----------
-            row : pd.Series
-                Table row to be inserted
-            unique_on : list / tuple
-                Column names that when combined indicate a unique row
-            values : list / tuple
-                Values to check row against
-            Returns
-            -------
-            bool
-            """
-            if isinstance(unique_on, str):
-                unique_on = [unique_on]
-            row_values = [row[c] for c in unique_on]
-            if len(row_values) > 1:
-                row_values = tuple(row_values)
-            else:
-                row_values = row_values[0]
-
-            return row_values in values
-
         # Check that records is not empty
         if len(records) == 0:
             logger.warning('No records to be added.')
@@ -460,118 +474,68 @@ class Postgres(object):
                            'exiting.'.format(table, self.database))
             sys.exit()
 
-        # Get unique IDs to remove duplicates if provided
-        if table in self.list_db_tables() and unique_on is not None:
-            # Remove duplicate values from rows to insert based on unique_on
-            # columns
-            existing_ids = self.get_values(table=table, columns=unique_on,
-                                           distinct=True)
-            logger.debug('Removing any existing IDs from search results...')
-            logger.debug('Existing unique IDs in table "{}": '
-                         '{:,}'.format(table, len(existing_ids)))
-
-            # Remove dups
-            starting_count = len(records)
-            records = records[~records.apply(lambda x: _row_columns_unique(
-                x, unique_on, existing_ids), axis=1)]
-            if len(records) != starting_count:
-                logger.info('Duplicates removed: {}'.format(starting_count -
-                                                            len(records)))
-        logger.info('IDs to add: {:,}'.format(len(records)))
-        if len(records) == 0:
-            logger.info('No new records, skipping indexing.')
-            return
-
-        geom_cols = get_geometry_cols(records)
-        if geom_cols:
-            # Get epsg code
-            srid = records.crs.to_epsg()
-        else:
-            geom_cols = []
-
         # Insert new records
-        if len(records) != 0:
-            logger.info('Writing new records to {}.{}: '
-                        '{:,}'.format(self.database, table, len(records)))
-
-            for i, row in tqdm(records.iterrows(),
-                               desc='Adding new records to: {}'.format(table),
-                               total=len(records)):
-                if dryrun:
-                    if i == 0:
-                        logger.info('-dryrun-')
-                    continue
-
-                # Format the INSERT query
-                columns = [sql.Identifier(c) for c in row.index if c not in
-                           geom_cols]
-                if geom_cols:
-                    for gc in geom_cols:
-                        columns.append(sql.Identifier(gc))
-                # Create INSERT statement, parenthesis left open intentionally
-                # to accommodate adding geometry statements, e.g.:
-                # "ST_GeomFromText(..)"
-                # paranthesis, closed in else block if no geometry columns
-                insert_statement = sql.SQL(
-                    "INSERT INTO {table} ({columns}) VALUES ({values}").format(
+        logger.info('Writing records to {}.{}: '
+                    '{:,}'.format(self.database, table, len(records)))
+        if isinstance(unique_on, str):
+            unique_on = [unique_on]
+        try:
+            if unique_on is None:
+                if not dryrun:
+                    copy_from_df(self.cursor, records, table)
+                new_count = len(records)
+            else:
+                # Stage records in a temporary table, then only insert those
+                # whose unique_on columns are not already in table. Values
+                # repeated within records keep their first row, as each row
+                # was previously inserted in order
+                staging = 'tmp_{}'.format(table)
+                self.cursor.execute(sql.SQL(
+                    "CREATE TEMP TABLE {staging} (LIKE {table} INCLUDING "
+                    "DEFAULTS) ON COMMIT DROP").format(
+                    staging=sql.Identifier(staging),
+                    table=sql.Identifier(table)))
+                copy_from_df(self.cursor,
+                             records.drop_duplicates(subset=unique_on,
+                                                     keep='first'),
+                             staging)
+                columns = sql.SQL(', ').join([sql.Identifier(c)
+                                              for c in records.columns])
+                new_records = sql.SQL(
+                    """SELECT {columns} FROM {staging} s
+                       WHERE NOT EXISTS (SELECT 1 FROM {table} t
+                                         WHERE {matches})""").format(
+                    columns=columns,
+                    staging=sql.Identifier(staging),
                     table=sql.Identifier(table),
-                    columns=sql.SQL(', ').join(columns),
-                    values=sql.SQL(', ').join([sql.Placeholder(f)
-                                               for f in row.index
-                                               if f not in geom_cols]),
-                )
-                if geom_cols:
-                    geom_statements = [sql.SQL(', ')]
-                    for i, gc in enumerate(geom_cols):
-                        if i != len(geom_cols) - 1:
-                            geom_statements.append(
-                                sql.SQL(
-                                    " ST_GeomFromText({gc}, {srid}),").format(
-                                    gc=sql.Placeholder(gc),
-                                    srid=sql.Literal(srid)))
-                        else:
-                            geom_statements.append(
-                                sql.SQL(
-                                    " ST_GeomFromText({gc}, {srid}))").format(
-                                    gc=sql.Placeholder(gc),
-                                    srid=sql.Literal(srid)))
-                    geom_statement = sql.Composed(geom_statements)
-                    insert_statement = insert_statement + geom_statement
+                    matches=sql.SQL(' AND ').join(
+                        [sql.SQL('t.{col} = s.{col}').format(
+                            col=sql.Identifier(c)) for c in unique_on]))
+                if dryrun:
+                    self.cursor.execute(sql.SQL(
+                        "SELECT COUNT(*) FROM ({}) n").format(new_records))
+                    new_count = self.cursor.fetchone()[0]
                 else:
-                    # Close paranthesis that was left open for geometries
-                    insert_statement = sql.SQL("{statement})").format(
-                        statement=insert_statement)
-
-                values = {f: row[f] if f not in geom_cols
-                          else row[f].wkt for f in row.index}
-
-                # Make the INSERT
-                with self.cursor as cursor:
-                    try:
-                        cursor.execute(self.cursor.mogrify(insert_statement,
-                                                           values))
-                        self.connection.commit()
-                    except Exception as e:
-                        if e == psycopg2.errors.UniqueViolation:
-                            logger.warning('Skipping due to unique violation '
-                                           'for scene: '
-                                           '{}'.format(row[unique_on]))
-                            logger.warning(e)
-                            self.connection.rollback()
-                        elif e == psycopg2.errors.IntegrityError:
-                            logger.warning('Skipping due to integrity error '
-                                           'for scene: '
-                                           '{}'.format(row[unique_on]))
-                            logger.warning(e)
-                            self.connection.rollback()
-                        else:
-                            logger.debug('Error on statement: {}'.format(
-                                f"{str(self.cursor.mogrify(insert_statement, values))}"))
-                            logger.error(e)
-                            self.connection.rollback()
-        else:
-            logger.info('No new records to be written.')
-            
+                    self.cursor.execute(sql.SQL(
+                        "INSERT INTO {table} ({columns}) {new_records}").format(
+                        table=sql.Identifier(table),
+                        columns=columns,
+                        new_records=new_records))
+                    new_count = self.cursor.rowcount
+                if new_count != len(records):
+                    logger.info('Duplicates removed: '
+                                '{:,}'.format(len(records) - new_count))
+            if dryrun:
+                logger.info('-dryrun-')
+                self.connection.rollback()
+            else:
+                self.connection.commit()
+            logger.info('IDs added: {:,}'.format(new_count))
+        except psycopg2.Error as e:
+            logger.error('Error writing records to {}'.format(table))
+            logger.error(e)
+            self.connection.rollback()
+
         logger.info('New count for {}.{}: '
                     '{:,}'.format(self.database, table,
                                   self.get_table_count(table)))
@@ -1,22 +1,42 @@
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 import copy
 import datetime
+from functools import lru_cache
 import hashlib
 import json
 import os
 from pathlib import Path, PurePosixPath
 import pathlib
 import platform
-import re
 import sys
 import time
-import xml.etree.ElementTree as ET
 
 import pandas as pd
 import geopandas as gpd
 import shapely
 from shapely.geometry import Point, Polygon
 from tqdm import tqdm
+# Use libxml2 based parsing if available
+try:
+    from lxml import etree as ET
+    HAS_LXML = True
+except ImportError:
+    import xml.etree.ElementTree as ET
+    HAS_LXML = False
+# Optional, faster JSON parsing and serialisation
+try:
+    import orjson
+    HAS_ORJSON = True
+except ImportError:
+    HAS_ORJSON = False
+# Optional, reads and writes vector files from columnar buffers rather
+# than feature-by-feature through fiona
+try:
+    import pyogrio
+    HAS_PYOGRIO = True
+except ImportError:
+    HAS_PYOGRIO = False
 
 from .logging_utils import create_logger
 import lib.constants as constants
@@ -35,31 +55,108 @@ except ImportError as e:
 
 config_file = Path(__file__).parent.parent / "config" / "config.json"
 
+# Operating system, looked up once rather than for each path converted
+SYSTEM = platform.system()
+
 
 # For identifying scene ids from file names
 SCENE_LEVELS = ['1B', '3B']
-
-# Shelving parent directory
-PLANET_DATA_DIR = PurePosixPath(
-    json.load(open(config_file))[constants.DOWNLOAD_LOC])
-
-
-def get_config(param):
+# Suffix of scene-level manifests
+SCENE_MANIFEST_SUFFIX = '_manifest.json'
+
+# Scene XML metadata
+# Nodes where all values can be processed as-is
+XML_NODES_PROCESS_ALL = [
+    '{http://schemas.planet.com/ps/v1'
+    '/planet_product_metadata_geocorrected_level}'
+    'EarthObservationMetaData',
+    '{http://www.opengis.net/gml}'
+    'TimePeriod',
+    '{http://schemas.planet.com/ps/v1'
+    '/planet_product_metadata_geocorrected_level}'
+    'Sensor',
+    '{http://schemas.planet.com/ps/v1'
+    '/planet_product_metadata_geocorrected_level}'
+    'Acquisition',
+    '{http://schemas.planet.com/ps/v1'
+    '/planet_product_metadata_geocorrected_level}'
+    'ProductInformation',
+    '{http://earth.esa.int/opt}'
+    'cloudCoverPercentage',
+    '{http://earth.esa.int/opt}'
+    'cloudCoverPercentageQuotationMode',
+    '{http://schemas.planet.com/ps/v1'
+    '/planet_product_metadata_geocorrected_level}'
+    'unusableDataPercentage',
+]
+# Nodes with repeated attribute names -> rename according to dicts
+XML_RENAME_NODES = [
+    ('{http://earth.esa.int/eop}Platform',
+     {'shortName': 'platform',
+      'serialIdentifier': 'serialIdentifier'}),
+    ('{http://earth.esa.int/eop}Instrument',
+     {'shortName': 'instrument'}),
+    ('{http://earth.esa.int/eop}MaskInformation',
+     {'fileName': 'mask_filename',
+      'type': 'mask_type',
+      'format': 'mask_format',
+      'referenceSystemIdentifier': 'mask_referenceSystemIdentifier'}),
+    ('{http://www.opengis.net/gml}LinearRing',
+     {'coordinates': 'geometry'}),
+    ('{http://www.opengis.net/gml}Point',
+     {'pos': 'centroid'}),
+]
+XML_SEARCH_NODES = (set(XML_NODES_PROCESS_ALL) |
+                    {node for node, _renamer in XML_RENAME_NODES})
+# Bands Node - conflicting attribute names -> add band number
+XML_BANDS_NODE = ('{http://schemas.planet.com/ps/v1'
+                  '/planet_product_metadata_geocorrected_level}'
+                  'bandSpecificMetadata')
+XML_BAND_NUMBER_SEARCH = ('.//{http://schemas.planet.com/ps/v1'
+                          '/planet_product_metadata_geocorrected_level}'
+                          'bandNumber')
+# Translation table removing quotes from band attribute names
+XML_QUOTE_STRIP = str.maketrans('', '', '"\'')
+
+# Number of files to checksum concurrently
+HASH_THREADS = os.cpu_count()
+# Bytes read at a time when checksumming files
+HASH_CHUNKSIZE = 1024 * 1024
+# Number of scene manifests to write concurrently
+MANIFEST_THREADS = 16
+
+
+@lru_cache(maxsize=1)
+def _load_config():
+    """Read and parse config.json once, returning the cached parameters
+    on subsequent calls."""
     try:
-        config_params = json.load(open(config_file))
+        with open(config_file) as src:
+            config_params = json.load(src)
     except FileNotFoundError:
         print('Config file not found at: {}'.format(config_file))
         print('Please create a config.json file based on the example.')
+        raise
 
+    return config_params
+
+
+def get_config(param):
+    config_params = _load_config()
     try:
         config = config_params[param]
     except KeyError:
         print('Config parameter not found: {}'.format(param))
         print('Available configs:\n{}'.format('\n'.join(config_params.keys())))
+        raise
 
     return config
 
 
+# Shelving parent directory
+PLANET_DATA_DIR = PurePosixPath(get_config(constants.DOWNLOAD_LOC))
+
+
 def win2linux(path):
     lp = path.replace('V:', r'/mnt').replace('\\', '/')
     return lp
@@ -73,9 +170,9 @@ def linux2win(path):
 
 
 def get_platform_location(path):
-    if platform.system() == constants.LINUX:
+    if SYSTEM == constants.LINUX:
         pl = win2linux(path)
-    elif platform.system() == constants.WINDOWS:
+    elif SYSTEM == constants.WINDOWS:
         pl = linux2win(path)
     return pl
 
@@ -154,18 +251,9 @@ def read_ids(ids_file, field=None, sep=None, stereo=False):
         df = pd.read_csv(ids_file, sep=sep, )
         ids = list(df[field])
 
-    # dbf
-    elif file_type == 'dbf':
-        df = gpd.read_file(ids_file)
-        ids = list(df[field])
-
-    # shp
-    elif file_type == 'shp':
-        df = gpd.read_file(ids_file)
-        ids = list(df[field])
-    # GEOJSON
-    elif file_type == 'geojson':
-        df = gpd.read_file(ids_file, driver='GeoJSON')
+    # dbf, shp, GEOJSON
+    elif file_type in ('dbf', 'shp', 'geojson'):
+        df = read_gdf(ids_file, columns=[field])
         ids = list(df[field])
     # GDF, DF
     elif file_type in ('gdf', 'df'):
@@ -239,6 +327,17 @@ def get_geometry_cols(gdf):
     return geom_cols
 
 
+def read_gdf(in_path, columns=None):
+    """Read a vector file to a GeoDataFrame, with pyogrio if available.
+    If columns are passed, pyogrio reads only those attribute columns."""
+    if HAS_PYOGRIO:
+        gdf = pyogrio.read_dataframe(str(in_path), columns=columns)
+    else:
+        gdf = gpd.read_file(in_path)
+
+    return gdf
+
+
 def write_gdf(gdf, out_footprint, out_format=None,
               date_format='%Y-%m-%d %H:%M:%S'):
     if not isinstance(out_footprint, pathlib.PurePath):
@@ -264,10 +363,16 @@ def write_gdf(gdf, out_footprint, out_format=None,
                        'EPSG:4326 to GeoJSON -> Reprojecting before writing.')
         gdf = gdf.to_crs('epsg:4326')
     if out_format == 'gpkg':
-        gdf.to_file(out_footprint.parent, layer=out_footprint.stem,
-                    driver='GPKG')
+        out_path = out_footprint.parent
+        layer = out_footprint.stem
+        driver = 'GPKG'
+    else:
+        out_path = out_footprint
+        layer = None
+    if HAS_PYOGRIO:
+        pyogrio.write_dataframe(gdf, str(out_path), layer=layer, driver=driver)
     else:
-        gdf.to_file(out_footprint, driver=driver)
+        gdf.to_file(out_path, layer=layer, driver=driver)
 
 
 def parse_group_args(parser, group_name):
@@ -302,22 +407,49 @@ def id_from_scene(scene, scene_levels=SCENE_LEVELS):
     return scene_id
 
 
+def load_json(json_path):
+    """Load a JSON file, using orjson if it is available."""
+    if HAS_ORJSON:
+        with open(json_path, 'rb') as src:
+            return orjson.loads(src.read())
+    with open(json_path, 'r') as src:
+        return json.load(src)
+
+
+def write_json(data, json_path):
+    """Write data to a JSON file, using orjson if it is available."""
+    if HAS_ORJSON:
+        with open(json_path, 'wb') as dst:
+            dst.write(orjson.dumps(data))
+    else:
+        with open(json_path, 'w') as dst:
+            json.dump(data, dst)
+
+
 def write_scene_manifest(scene_manifest: dict, master_manifest: Path,
                          manifest_suffix: str = constants.MANIFEST_SUFFIX,
-                         overwrite: bool = False):
+                         overwrite: bool = False,
+                         dir_listings: dict = None):
     """
     Write the section of the parent manifest for an individual scene
-    to a new file with that scenes name.
+    to a new file with that scenes name. If dir_listings is passed, it
+    is used to cache the file names in each scene directory, which are
+    checked for the manifest rather than stat-ing its path.
     """
     scene_path = Path(scene_manifest[constants.PATH])
     scene_mani_name = '{}_{}.json'.format(scene_path.stem, manifest_suffix)
     scene_mani_path = (master_manifest.parent / scene_path.parent /
                        scene_mani_name)
-    exists = scene_mani_path.exists()
+    if dir_listings is None:
+        exists = scene_mani_path.exists()
+    else:
+        scene_dir = str(scene_mani_path.parent)
+        if scene_dir not in dir_listings:
+            dir_listings[scene_dir] = frozenset(os.listdir(scene_dir))
+        exists = scene_mani_name in dir_listings[scene_dir]
     if not exists or (exists and overwrite):
         logger.debug('Writing manifest for: {}'.format(scene_path.stem))
-        with open(scene_mani_path, 'w') as scene_mani_out:
-            json.dump(scene_manifest, scene_mani_out)
+        write_json(scene_manifest, scene_mani_path)
     elif exists and not overwrite:
         logger.debug('Scene manifest exists, skipping.')
 
@@ -337,8 +469,7 @@ def get_scene_manifests(master_manifest: str) -> list:
     list: list of sections of order manifest corresponding to
         scene image files
     """
-    with open(master_manifest, 'r') as src:
-        mani = json.load(src)
+    mani = load_json(master_manifest)
 
     # Get metadata for all images
     scene_manifests = []
@@ -364,25 +495,33 @@ def create_scene_manifests(master_manifest, overwrite=False):
                                   time.localtime(os.path.getmtime(
                                       master_manifest)))
 
-    scene_manifest_files = []
-    # pbar = tqdm(scene_manifests,
-                # desc='Writing scene-level manifest.json files'
-                # )
-    # for sm in pbar:
     for sm in scene_manifests:
         sm[constants.RECEIVED_DATETIME] = received_date
-        scene_manifest_file = write_scene_manifest(sm, master_manifest,
-                                                   overwrite=overwrite)
-        scene_manifest_files.append(scene_manifest_file)
+    # Many scenes share a directory, list each once rather than checking
+    # for each scene manifest
+    dir_listings = dict()
+    # Each scene manifest is a separate small file, write them concurrently
+    with ThreadPoolExecutor(max_workers=MANIFEST_THREADS) as executor:
+        scene_manifest_files = list(executor.map(
+            lambda sm: write_scene_manifest(sm, master_manifest,
+                                            overwrite=overwrite,
+                                            dir_listings=dir_listings),
+            scene_manifests))
 
     return scene_manifest_files
 
 
 def create_file_md5(fname):
-    hash_md5 = hashlib.md5()
-    with open(fname, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            hash_md5.update(chunk)
+    with open(fname, "rb", buffering=0) as f:
+        # Python >= 3.11, reads into a buffer in C
+        if hasattr(hashlib, 'file_digest'):
+            return hashlib.file_digest(f, 'md5').hexdigest()
+        # Otherwise read large chunks into a single reused buffer
+        hash_md5 = hashlib.md5()
+        buf = bytearray(HASH_CHUNKSIZE)
+        view = memoryview(buf)
+        for n in iter(lambda: f.readinto(buf), 0):
+            hash_md5.update(view[:n])
 
     return hash_md5.hexdigest()
 
@@ -400,48 +539,94 @@ def verify_scene_md5(manifest_md5, scene_file):
     return verified
 
 
+def verify_scenes_md5(scenes, threads=HASH_THREADS):
+    """Verify the checksums of many PlanetScenes concurrently. Results are
+    cached on each scene (PlanetScene.valid_checksum). hashlib releases the
+    GIL while hashing, so files are hashed in parallel across threads."""
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        verified = list(tqdm(executor.map(lambda ps: ps.verify_checksum(),
+                                          scenes),
+                             total=len(scenes),
+                             desc='Verifying scene checksums...'))
+
+    return verified
+
+
 def verify_all_checksums(scenes, verify_checksums=True):
     # Verify checksum, or mark all as skip if not checking
     if verify_checksums:
         logger.info('Verifying scene checksums...')
-        for ps in tqdm(scenes, desc='Verifying scene checksums...'):
-            ps.verify_checksum()
+        verify_scenes_md5(scenes)
     else:
         logger.info('Skipping checksum verification...')
         for ps in scenes:
             ps.skip_checksum = True
 
 
-def tag_uri_and_name(elem):
-    """Parse XML elements into uris and names"""
-    if elem.tag[0] == '{':
-        uri, _, name = elem.tag[1:].partition('}')
+def parse_xml(xml_path):
+    """Parse an XML file, returning the root element. With lxml, comments
+    and processing instructions are dropped so that iterating over an
+    element only yields elements, as with xml.etree."""
+    if HAS_LXML:
+        # Parsers are not shared between threads, so create one per call
+        parser = ET.XMLParser(remove_comments=True, remove_pis=True)
+    else:
+        parser = None
+    tree = ET.parse(str(xml_path), parser=parser)
+
+    return tree.getroot()
+
+
+@lru_cache(maxsize=4096)
+def split_tag(tag):
+    """Split a namespace qualified tag into uri and name. Cached as the
+    same few tags occur in every XML file."""
+    if tag[0] == '{':
+        uri, _, name = tag[1:].partition('}')
     else:
         uri = None
-        name = elem.tag
+        name = tag
 
     return uri, name
 
 
-def add_renamed_attributes(node, renamer, root, attributes):
+def tag_uri_and_name(elem):
+    """Parse XML elements into uris and names"""
+    return split_tag(elem.tag)
+
+
+def add_renamed_attributes(elems, renamer, attributes):
     """
     Parse XML elements that would overwrite other attributes to
-    rename them before adding them to the attributes dict
+    rename them before adding them to the attributes dict. elems is
+    the parent element whose children are added.
     """
-    elems = root.find('.//{}'.format(node))
     for e in elems:
         uri, name = tag_uri_and_name(e)
-        if name in renamer.keys():
+        if name in renamer:
             name = renamer[name]
-        if e.text.strip() != '':
-            attributes[name] = e.text
+        t = e.text
+        if t and not t.isspace():
+            attributes[name] = t
+
+
+def find_scene_manifests(directory):
+    """Generator of paths to the scene-level manifests under directory.
+    Walks the tree with os.scandir, which gets whether each entry is a
+    directory from the directory listing rather than stat-ing each path."""
+    stack = [str(directory)]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name.endswith(SCENE_MANIFEST_SUFFIX):
+                    yield Path(entry.path)
 
 
 def find_planet_scenes(directory, exclude_meta=None,
                        shelved_parent=None):
-    if not isinstance(directory, pathlib.PurePath):
-        directory = Path(directory)
-    manifest_files = directory.rglob('*_manifest.json')
+    manifest_files = find_scene_manifests(directory)
 
     planet_scenes = [PlanetScene(mf, exclude_meta=exclude_meta,
                                  shelved_parent=shelved_parent)
@@ -581,21 +766,20 @@ class PlanetScene:
         # Parse source for attributes
         # TODO: fix how these attributes are parsed currently from
         #  scene-level manifest
-        with open(str(self.manifest), 'r') as src:
-            data = json.load(src)
-            # Find the scene path within the source
-            _digests = data[constants.DIGESTS]
-            _annotations = data[constants.ANNOTATIONS]
-            self.scene_path = self.manifest.parent / \
-                              Path(data[constants.PATH]).name
-            self.media_type = data[constants.SIZE]
-            self.md5 = _digests[constants.MD5]
-            self.sha256 = _digests[constants.SHA256]
-            self.asset_type = _annotations[constants.PLANET_ASSET_TYPE]
-            self.bundle_type = _annotations[constants.PLANET_BUNDLE_TYPE]
-            self.item_id = _annotations[constants.PLANET_ITEM_ID]
-            self.item_type = _annotations[constants.PLANET_ITEM_TYPE]
-            self.received_datetime = data[constants.RECEIVED_DATETIME]
+        data = load_json(self.manifest)
+        # Find the scene path within the source
+        _digests = data[constants.DIGESTS]
+        _annotations = data[constants.ANNOTATIONS]
+        self.scene_path = self.manifest.parent / \
+                          Path(data[constants.PATH]).name
+        self.media_type = data[constants.SIZE]
+        self.md5 = _digests[constants.MD5]
+        self.sha256 = _digests[constants.SHA256]
+        self.asset_type = _annotations[constants.PLANET_ASSET_TYPE]
+        self.bundle_type = _annotations[constants.PLANET_BUNDLE_TYPE]
+        self.item_id = _annotations[constants.PLANET_ITEM_ID]
+        self.item_type = _annotations[constants.PLANET_ITEM_TYPE]
+        self.received_datetime = data[constants.RECEIVED_DATETIME]
 
         # Determine "scene name" - the scene name without post processing
         # suffixes used when searching for metadata files, e.g.: _SR
@@ -664,10 +848,9 @@ class PlanetScene:
         if self._strip_id is None and self.strip_id_found is not False:
             if self.metadata_json.exists():
                 try:
-                    with open(self.metadata_json) as src:
-                        content = json.load(src)
-                        self._strip_id = content['properties']['strip_id']
-                        self.strip_id_found = True
+                    content = load_json(self.metadata_json)
+                    self._strip_id = content['properties']['strip_id']
+                    self.strip_id_found = True
                 except Exception as e:
                     self.strip_id_found = False
                     logger.warning('Error getting strip_id for scene: '
@@ -717,8 +900,8 @@ class PlanetScene:
     @property
     def xml_path(self):
         if self._xml_path is None:
-            xml_expr = re.compile('.*.xml')
-            xml_matches = list(p for p in self.meta_files if xml_expr.match(str(p)))
+            xml_matches = [p for p in self.meta_files
+                           if p.suffix.lower() == '.xml']
             if len(xml_matches) == 1:
                 if xml_matches[0].exists():
                     self._xml_path = xml_matches[0]
@@ -746,115 +929,60 @@ class PlanetScene:
                 logger.debug('Parsing attributes from xml: '
                              '{}'.format(self.xml_path))
                 try:
-                    with open(self.xml_path, 'rt') as src:
-                        tree = ET.parse(self.xml_path)
-                        root = tree.getroot()
+                    root = parse_xml(self.xml_path)
                 except Exception as e:
                     logger.error('Error reading XML metadata file: '
                                  '{}'.format(self.xml_path))
                     self.xml_valid = False
                     return
 
-                # Nodes where all values can be processed as-is
-                nodes_process_all = [
-                    '{http://schemas.planet.com/ps/v1'
-                    '/planet_product_metadata_geocorrected_level}'
-                    'EarthObservationMetaData',
-                    '{http://www.opengis.net/gml}'
-                    'TimePeriod',
-                    '{http://schemas.planet.com/ps/v1'
-                    '/planet_product_metadata_geocorrected_level}'
-                    'Sensor',
-                    '{http://schemas.planet.com/ps/v1'
-                    '/planet_product_metadata_geocorrected_level}'
-                    'Acquisition',
-                    '{http://schemas.planet.com/ps/v1'
-                    '/planet_product_metadata_geocorrected_level}'
-                    'ProductInformation',
-                    '{http://earth.esa.int/opt}'
-                    'cloudCoverPercentage',
-                    '{http://earth.esa.int/opt}'
-                    'cloudCoverPercentageQuotationMode',
-                    '{http://schemas.planet.com/ps/v1'
-                    '/planet_product_metadata_geocorrected_level}'
-                    'unusableDataPercentage',
-                    ]
-
-                # Nodes with repeated attribute names
-                # -> rename according to dicts
-                platform_node = '{http://earth.esa.int/eop}Platform'
-                instrument_node = '{http://earth.esa.int/eop}Instrument'
-                mask_node = '{http://earth.esa.int/eop}MaskInformation'
-                geom_node = '{http://www.opengis.net/gml}LinearRing'
-                centroid_node = '{http://www.opengis.net/gml}Point'
-
-                platform_renamer = {'shortName': 'platform',
-                                    'serialIdentifier': 'serialIdentifier'}
-                insrument_renamer = {'shortName': 'instrument'}
-                mask_renamer = {'fileName': 'mask_filename',
-                                'type': 'mask_type',
-                                'format': 'mask_format',
-                                'referenceSystemIdentifier':
-                                    'mask_referenceSystemIdentifier'}
-                geom_renamer = {'coordinates': 'geometry'}
-                centroid_renamer = {'pos': 'centroid'}
-
-                rename_nodes = [(platform_node, platform_renamer),
-                                (instrument_node, insrument_renamer),
-                                (mask_node, mask_renamer),
-                                (geom_node, geom_renamer),
-                                (centroid_node, centroid_renamer)]
-
-                # Bands Node - conflicting attribute names
-                # -> add band number: "band1_radiometicScaleFactor"
-                bands_node = ('{http://schemas.planet.com/ps/v1'
-                              '/planet_product_metadata_geocorrected_level}'
-                              'bandSpecificMetadata')
-                band_number_node = ('{http://schemas.planet.com/ps/v1'
-                                    '/planet_product_metadata_geocorrected_'
-                                    'level}'
-                                    'bandNumber')
+                # Locate all nodes in a single pass over the tree, rather
+                # than a search of the tree per node. Keep only the first
+                # match of each node (as find() would) and all band nodes.
+                node_elems = dict()
+                bands_elems = []
+                for elem in root.iter():
+                    if elem.tag == XML_BANDS_NODE:
+                        bands_elems.append(elem)
+                    elif (elem.tag in XML_SEARCH_NODES and
+                          elem.tag not in node_elems):
+                        node_elems[elem.tag] = elem
 
                 attributes = dict()
 
                 # Add attributes that are processed as-is
-                for node in nodes_process_all:
-                    elems = root.find('.//{}'.format(node))
+                for node in XML_NODES_PROCESS_ALL:
+                    elems = node_elems[node]
                     for e in elems:
                         uri, name = tag_uri_and_name(e)
-                        if e.text.strip() != '':
-                            # print('{}: {}'.format(name, e.text))
-                            attributes[name] = e.text
+                        t = e.text
+                        if t and not t.isspace():
+                            attributes[name] = t
 
                 # Add attributes that require renaming
-                for node, renamer in rename_nodes:
-                    add_renamed_attributes(node, renamer, root=root,
+                for node, renamer in XML_RENAME_NODES:
+                    add_renamed_attributes(node_elems[node], renamer,
                                            attributes=attributes)
 
-                # Process band metadata
-                bands_elems = root.findall('.//{}'.format(bands_node))
+                # Process band metadata, prefixing names with the band
+                # number: "band1_radiometicScaleFactor"
                 for band in bands_elems:
-                    band_uri = '{{{}}}'.format(tag_uri_and_name(band)[0])
-                    band_number = (band.find('.//{}'.format(band_number_node)).
-                                   text)
-                    band_renamer = {tag_uri_and_name(e)[1]:
-                                    'band{}_{}'.format(band_number,
-                                                       tag_uri_and_name(e)[1])
-                                    for e in band
-                                    if tag_uri_and_name(e)[1] != 'bandNumber'}
+                    prefix = 'band{}_'.format(
+                        band.find(XML_BAND_NUMBER_SEARCH).text)
                     for e in band:
-                        band_uri, name = tag_uri_and_name(e)
-                        if name in band_renamer.keys():
-                            name = band_renamer[name]
+                        uri, name = tag_uri_and_name(e)
+                        if name == 'bandNumber':
+                            continue
                         # Remove quotes from field names (some have them, some
                         # do not)
-                        name = name.replace('"', '').replace("'", '')
-                        if e.text.strip() != '' and name != 'bandNumber':
-                            attributes[name] = e.text
+                        name = prefix + name
+                        name = name.translate(XML_QUOTE_STRIP)
+                        t = e.text
+                        if t and not t.isspace():
+                            attributes[name] = t
 
                 # Convert geometry to shapely Polygon
                 points = attributes['geometry'].split()
-                pts = [(pt.split(',')) for pt in points]
                 pts = [tuple(pt.split(',')) for pt in points]
                 pts = [tuple(float(x) for x in p) for p in pts]
                 self._geometry = Polygon(pts)
@@ -1022,7 +1150,7 @@ class PlanetScene:
             uns_index_row[constants.RECEIVED_DATETIME] = self.received_datetime
             uns_index_row[constants.SHELVED_LOC] = str(self.shelved_location)
             # Use only linux paths in index - /mnt/pgc/data/.., not V:\pgc\data\...
-            if platform.system() == constants.WINDOWS:
+            if SYSTEM == constants.WINDOWS:
                 uns_index_row[constants.SHELVED_LOC] = \
                     linux2win(uns_index_row[constants.SHELVED_LOC])
 
@@ -1052,6 +1180,9 @@ class PlanetScene:
         if self._footprint_row is None:
             self._footprint_row = copy.deepcopy(self.index_row)
             self._footprint_row.pop(constants.SHELVED_LOC, None)
+            # Footprints can only have one geometry column, center_x and
+            # center_y remain
+            self._footprint_row.pop(constants.CENTROID, None)
             if rel_to:
                 self._footprint_row[constants.REL_LOCATION] = str(
                     self.scene_path.relative_to(rel_to))
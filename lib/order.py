@@ -6,19 +6,19 @@ import pathlib
 import requests
 import time
 import sys
+import threading
 import zipfile
 
-from itertools import product
-from multiprocessing.dummy import Pool as ThreadPool
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 from requests.auth import HTTPBasicAuth
-from retrying import retry, RetryError
 
 try:
     import boto3
 except ImportError:
     print('Warning: boto3 import failed, delivery via AWS will not work.')
 import geopandas as gpd
+from tqdm import tqdm
 
 from lib.lib import read_ids, stereo_pair_sql
 # from lib.db import Postgres, stereo_pair_sql
@@ -119,10 +119,12 @@ def download_url(url, save_path, chunk_size=1024):
             fd.write(chunk)
 
 
-def dl_order(oid, dst_par_dir, delivery, bucket=None, overwrite=False, dryrun=False):
+def dl_order(oid, dst_par_dir, delivery, bucket=None, overwrite=False, dryrun=False,
+             scratch_dir=None):
     """Download an order id (oid) to destination parent directory, creating
     a new subdirectory for the order id. Order ID is also name of subdirectory
-    in AWS bucket."""
+    in AWS bucket. For AWS deliveries, files can be downloaded to scratch_dir
+    first and then moved to the destination."""
     # TODO: Resolve why at least dst_par dir is not coming in as Path
     if not isinstance(oid, pathlib.PurePath):
         oid = Path(oid)
@@ -138,10 +140,11 @@ def dl_order(oid, dst_par_dir, delivery, bucket=None, overwrite=False, dryrun=Fa
 
     # AWS
     if delivery == constants.AWS:
-        dl_issues = aws_utils.dl_aws(oid=oid, dst_par_dir=dst_par_dir,
-                                     oid_dir=oid_dir, bucket=bucket,
-                                     overwrite=overwrite,
-                                     dryrun=dryrun)
+        failed_keys = aws_utils.dl_aws(oid=oid, dst_par_dir=dst_par_dir,
+                                       oid_dir=oid_dir, bucket=bucket,
+                                       overwrite=overwrite,
+                                       dryrun=dryrun,
+                                       scratch_dir=scratch_dir)
     elif delivery == constants.ZIP:
         order_status_url = '{}/{}'.format(constants.ORDERS_URL, oid)
         r = get_url(order_status_url, auth=auth)
@@ -168,11 +171,11 @@ def dl_order(oid, dst_par_dir, delivery, bucket=None, overwrite=False, dryrun=Fa
                     unzip_delivery(dest_path, unzipped_dest)
         # TODO: create a method for actually checking success of direct
         #  downloads (existence of download zip?
-        dl_issues = [None]
+        failed_keys = []
 
     logger.info('Done.')
 
-    all_success = any(dl_issues)
+    all_success = not failed_keys
 
     return all_success
 
@@ -180,28 +183,31 @@ def dl_order(oid, dst_par_dir, delivery, bucket=None, overwrite=False, dryrun=Fa
 def dl_order_when_ready(order_id, dst_par_dir, delivery,
                         bucket=None,
                         overwrite=False, dryrun=False,
-                        wait_start=2, wait_interval=10,
-                        wait_max_interval=300, wait_max=5400):
+                        wait_start=2, wait_max_interval=300, wait_max=5400,
+                        manifest_event=None, watch_done=None,
+                        scratch_dir=None):
     """
     Wrapper for dl_order that checks if order is ready before downloading.
-    Checks every [wait_start] seconds, increasing by [wait_interval] until
-    [wait_max_interval] is reached and then every [wait_max_interval]
-    until [wait_max] is reached at which point the attempt to download is aborted.
+    Checks after [wait_start] seconds, doubling the wait (with jitter) up to
+    [wait_max_interval] until [wait_max] is reached at which point the
+    attempt to download is aborted.
     For AWS, checks if source.json is present in order subdirectory in AWS bucket
-    before downloading.
+    before downloading. If manifest_event is passed, it is set by a shared
+    aws_utils.watch_aws_deliveries thread instead of polling for this order,
+    and waiting stops once that thread sets watch_done.
     For ZIP, checks if order status is success.
     # TODO: All delivery methods could likely use ZIP method of GETting the status
     """
     logger.debug('Waiting for orders to arrive in AWS...')
-    start_time = datetime.datetime.now()
-    running_time = (datetime.datetime.now() - start_time).total_seconds()
-    wait = wait_start
     start_dl = False
     if delivery == constants.AWS:
-        aws_utils.check_aws_delivery_status(order_id=order_id, bucket=bucket,
-                                            wait_max=wait_max,
-                                            wait_interval=wait_interval,
-                                            wait_max_interval=wait_max_interval)
+        start_dl = aws_utils.check_aws_delivery_status(order_id=order_id,
+                                                       bucket=bucket,
+                                                       wait_max=wait_max,
+                                                       wait_start=wait_start,
+                                                       wait_max_interval=wait_max_interval,
+                                                       manifest_event=manifest_event,
+                                                       watch_done=watch_done)
     elif delivery == constants.ZIP:
         start_dl, _response = poll_for_success(order_id=order_id)
 
@@ -209,7 +215,8 @@ def dl_order_when_ready(order_id, dst_par_dir, delivery,
         logger.info('Started downloading: {}'.format(order_id))
         all_success = dl_order(order_id, dst_par_dir=dst_par_dir, delivery=delivery,
                                bucket=bucket,
-                               overwrite=overwrite, dryrun=dryrun)
+                               overwrite=overwrite, dryrun=dryrun,
+                               scratch_dir=scratch_dir)
     else:
         logger.info('Maximum wait reached, did not begin download: {}'.format(order_id))
         all_success = False
@@ -221,28 +228,52 @@ def download_parallel(order_ids, dst_par_dir, delivery,
                       overwrite=False,
                       dryrun=False,
                       threads=4,
-                      wait_max=WAIT_MAX):
+                      wait_max=WAIT_MAX,
+                      scratch_dir=None):
     """
     Download order ids in parallel.
     """
     if delivery == constants.AWS:
         bucket = aws_utils.connect_aws_bucket()
+        # Poll for all orders' manifests from a single thread
+        manifest_events = {oid: threading.Event() for oid in order_ids}
+        watch_done = threading.Event()
+        watcher = threading.Thread(target=aws_utils.watch_aws_deliveries,
+                                   args=(manifest_events, bucket, wait_max),
+                                   kwargs={'watch_done': watch_done},
+                                   daemon=True)
+        watcher.start()
     else:
         bucket = None
-
-    pool = ThreadPool(threads)
-    # Create a dl_order_when_ready call for each order id in order_ids,
-    # with the specified arguments
-    results = pool.starmap(dl_order_when_ready,
-                           product(order_ids, [dst_par_dir], [delivery],
-                                   [bucket], [overwrite], [dryrun], [2], [10],
-                                   [wait_max]))
-    pool.close()
-    pool.join()
-
-    logger.info('Download statuses:\nOrder ID\t\t\t\t\t\t\t\tStarted\t\t\t\tIssue\n{}'.format(
-        '\n'.join(["{}\t\t{}\t\t\t{}".format(oid, start_dl, issue)
-                   for oid, start_dl, issue in results])
+        manifest_events = {oid: None for oid in order_ids}
+        watch_done = None
+
+    # Submit a dl_order_when_ready call for each order id in order_ids,
+    # collecting results as each order finishes
+    results = []
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        futures = {executor.submit(dl_order_when_ready, oid,
+                                   dst_par_dir=dst_par_dir,
+                                   delivery=delivery, bucket=bucket,
+                                   overwrite=overwrite, dryrun=dryrun,
+                                   wait_max=wait_max,
+                                   manifest_event=manifest_events[oid],
+                                   watch_done=watch_done,
+                                   scratch_dir=scratch_dir): oid
+                   for oid in order_ids}
+        for future in tqdm(as_completed(futures), total=len(futures),
+                           desc='Orders', position=0):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                logger.error('Error downloading order: '
+                             '{}'.format(futures[future]))
+                logger.error(e)
+                results.append((futures[future], None, False))
+
+    logger.info('Download statuses:\nOrder ID\t\t\t\t\t\t\t\tStarted\t\t\t\tSuccess\n{}'.format(
+        '\n'.join(["{}\t\t{}\t\t\t{}".format(oid, start_dl, all_success)
+                   for oid, start_dl, all_success in results])
     ))
 
     return results
@@ -16,7 +16,7 @@ from retrying import retry
 from shapely.geometry import Point, Polygon
 from tqdm import tqdm
 
-from lib.lib import read_ids, write_gdf
+from lib.lib import load_json, read_ids, write_gdf
 from lib.db import Postgres
 from lib.logging_utils import create_logger
 import lib.constants as constants
@@ -584,7 +584,7 @@ def create_search(name, item_types,
 
     # Parse any provided filters
     if load_filter:
-        addtl_filter = json.load(open(load_filter))
+        addtl_filter = load_json(load_filter)
         search_filters.append(addtl_filter)
 
     # Parse any asset filters
@@ -817,7 +817,7 @@ def get_search_page_urls(saved_search_id, total_count):
 
 
 @retry(wait_exponential_multiplier=1000, wait_exponential_max=10000,
-       stop_max_delay=30000)
+       wait_jitter_max=1000, stop_max_delay=30000)
 def process_page(page_url):
     session = get_session()
     res = session.get(page_url)
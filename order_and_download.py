@@ -35,6 +35,7 @@ def order_and_download(order_name, order_ids_path,
                        download_par_dir=default_dst_parent,
                        overwrite_downloads=False,
                        dl_orders=None,
+                       scratch_dir=None,
                        dryrun=False):
     """Submit orders to Planet API with delivery to AWS. Selection will
     be chunked into groups of 500 IDs/order  Download order from AWS
@@ -73,7 +74,8 @@ def order_and_download(order_name, order_ids_path,
         logger.info('Checking for ready orders...')
         download_parallel(order_ids, dst_par_dir=download_par_dir,
                           delivery=delivery,
-                          overwrite=overwrite_downloads, dryrun=dryrun)
+                          overwrite=overwrite_downloads, dryrun=dryrun,
+                          scratch_dir=scratch_dir)
 
 if __name__ == '__main__':
     # Choices
@@ -124,6 +126,10 @@ if __name__ == '__main__':
     #                                 'to arrive in AWS before skipping, in milliseconds.')
     download_args.add_argument('--overwrite', action='store_true',
                                 help='Overwrite files in destination. Otherwise duplicates are skipped.')
+    download_args.add_argument('--scratch_directory', type=os.path.abspath,
+                                help="""Local directory to download AWS deliveries to 
+                                before moving them to the destination. Useful when the 
+                                destination is a network share.""")
     download_args.add_argument('-l', '--logfile', type=os.path.abspath,
                                 help='Location to write log to.')
 
@@ -162,6 +168,7 @@ if __name__ == '__main__':
     download_par_dir = args.destination_parent_directory
     # wait_max = args.wait_max
     overwrite_downloads = args.overwrite
+    scratch_dir = args.scratch_directory
 
     dryrun = args.dryrun
     logfile = args.logfile
@@ -196,5 +203,6 @@ if __name__ == '__main__':
                        # wait_max=wait_max,
                        dl_orders=download_orders,
                        overwrite_downloads=overwrite_downloads,
+                       scratch_dir=scratch_dir,
                        dryrun=dryrun)
 
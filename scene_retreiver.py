@@ -5,11 +5,10 @@ import platform
 import shutil
 import sys
 
-import geopandas as gpd
 from tqdm import tqdm
 
 # from lib.db import Postgres, ids2sql
-from lib.lib import get_config, linux2win, read_ids, write_gdf, \
+from lib.lib import get_config, linux2win, read_ids, read_gdf, write_gdf, \
     get_platform_location, PlanetScene
 # from shelve_scenes import shelve_scenes
 from lib.logging_utils import create_logger
@@ -67,7 +66,7 @@ def load_selection(scene_ids_path=None, footprint_path=None):
 
     elif footprint_path:
         # Use provided footprint
-        gdf = gpd.read_file(footprint_path)
+        gdf = read_gdf(footprint_path)
         # Make sure required fields are present
         for field in [constants.SHELVED_LOC, constants.ID]:
             if field not in gdf.columns:
@@ -11,7 +11,8 @@ import geopandas as gpd
 from tqdm import tqdm
 
 # from lib.db import Postgres
-from lib.lib import create_scene_manifests, PlanetScene, get_config, linux2win
+from lib.lib import create_scene_manifests, PlanetScene, get_config, linux2win, \
+    find_scene_manifests, verify_scenes_md5
 from lib.logging_utils import create_logger, create_logfile_path
 
 logger = create_logger(__name__, 'sh', 'INFO')
@@ -204,7 +205,8 @@ def create_scenes(scene_manifests: list,
     return scenes
 
 
-def identify_shelveable_indexable(scenes: List[PlanetScene]) -> Tuple[list]:
+def identify_shelveable_indexable(scenes: List[PlanetScene],
+                                  verify_checksums: bool = True) -> Tuple[list]:
     """
     Identify which scenes are shelveable and/or indexable, and
     which are neither shelveable nor indexable.
@@ -223,6 +225,10 @@ def identify_shelveable_indexable(scenes: List[PlanetScene]) -> Tuple[list]:
     ----------
     scenes: list
         List of PlanetScene objects
+    verify_checksums: bool
+        True to verify the checksums of scenes to be shelved and/or
+        indexed. These are verified concurrently once all scenes
+        have been checked.
 
     Returns
     -------
@@ -241,14 +247,14 @@ def identify_shelveable_indexable(scenes: List[PlanetScene]) -> Tuple[list]:
 
     # Locate scenes that are not shelveable, or have already been shelved
     # and indexed
-    # TODO: Speed up, multiprocess?
-    logger.info('Parsing XML files and verifying checksums...')
+    logger.info('Parsing XML files...')
     scenes2skip = []
     scenes2shelve = []
     scenes2index = []
+    scenes2verify = []
     unshelveable_count = 0
     bad_checksum_count = 0
-    for ps in tqdm(scenes, desc='Parsing XML files and verifying checksums:'):
+    for ps in tqdm(scenes, desc='Parsing XML files:'):
         # Check if scene is shelveable or has been shelved and indexed
         # first to avoid verifying checksums for scenes that don't are
         # unshelveable or don't need to be reshelved
@@ -281,9 +287,15 @@ def identify_shelveable_indexable(scenes: List[PlanetScene]) -> Tuple[list]:
             scenes2skip.append(ps)
             continue
 
-        # Verify checksums
         if verify_checksums:
-            if not ps.verify_checksum():
+            scenes2verify.append(ps)
+
+    # Verify checksums of remaining scenes concurrently
+    if scenes2verify:
+        logger.info('Verifying checksums...')
+        verified = verify_scenes_md5(scenes2verify)
+        for ps, valid in zip(scenes2verify, verified):
+            if not valid:
                 logger.warning('Invalid checksum: '
                                '{}'.format(ps.scene_path))
                 bad_checksum_count += 1
@@ -478,11 +490,15 @@ def index_scenes(scenes2index: List[PlanetScene],
     """
     logger.info('Building index rows for scenes: '
                 '{:,}'.format(len(scenes2index)))
-    gdf = gpd.GeoDataFrame([s.index_row for s in scenes2index if s.shelveable],
+    index_rows = [s.index_row for s in scenes2index if s.shelveable]
+    if not index_rows:
+        logger.info('No shelveable scenes to index.')
+        return
+    gdf = gpd.GeoDataFrame(index_rows,
                            geometry=INDEX_GEOM,
                            crs=INDEX_CRS)
 
-    logger.info('Indexing shelveable scenes: {:,}'.format(len(scenes2index)))
+    logger.info('Indexing shelveable scenes: {:,}'.format(len(gdf)))
     with Postgres(host=SANDWICH, database=PLANET) as db_src:
         db_src.insert_new_records(gdf,
                                   table=index_tbl,
@@ -582,7 +598,7 @@ def shelve_and_index(input_directory: Union[Path, str],
         scene_manifests = create_all_scene_manifests(input_directory)
     elif scene_manifests_exist:
         logger.info('Locating scene manifests...')
-        scene_manifests = input_directory.rglob('*_manifest.json')
+        scene_manifests = find_scene_manifests(input_directory)
 
     # Create PlanetScene objects for each scene found in input directory
     scenes = create_scenes(scene_manifests=scene_manifests,
@@ -591,7 +607,8 @@ def shelve_and_index(input_directory: Union[Path, str],
     # Locate scenes that are shelveable and/or indexable, and those that are
     # not and should be skipped. There may (likely will) be repeated scenes
     # in scenes2shelve and scenes2index.
-    scenes2shelve, scenes2index, scenes2skip = identify_shelveable_indexable(scenes=scenes)
+    scenes2shelve, scenes2index, scenes2skip = identify_shelveable_indexable(
+        scenes=scenes, verify_checksums=verify_checksums)
 
     # Manage unshelveable scenes, i.e don't have valid checksum, associated
     # xml not found, etc., by either deleting or copying them